@@ -1,17 +1,128 @@
 from collections import deque
 from enum import Enum
+import ctypes
+import errno
+import heapq
+import io
+import mmap
 import os
+import queue
+import threading
 import time
+import shutil
 import signal
+import stat
+import sys
 import traceback
-from typing import BinaryIO
+from typing import BinaryIO, Iterator
 import numpy as np
 import json
 from datetime import datetime, timedelta
 import pytz
 import argparse
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import atexit
 from version import __version__
 
+# orjson encodes and decodes the cache several times faster than the standard library, if installed
+try:
+    import orjson
+
+    _json_dumps = orjson.dumps
+    _json_loads = orjson.loads
+except ImportError:
+
+    def _json_dumps(obj) -> bytes:
+        return json.dumps(obj, separators=(",", ":")).encode()
+
+    _json_loads = json.loads
+
+
+# errors of sendfile / copy_file_range telling that the files are not supported by the kernel copy
+_KERNEL_COPY_UNSUPPORTED = {errno.EINVAL, errno.ENOSYS, errno.EXDEV, errno.ENOTSOCK, errno.EOPNOTSUPP}
+
+# new files up to this size are copied by shutil.copyfile in one go, without progress
+_FAST_COPY_MAX_SIZE = 64 * 1024 * 1024
+
+# bytes moved per step of the copy loop, and number of chunks read ahead by the fallback loop
+_CHUNK_SIZE = 8 * 1024 * 1024
+_PIPELINE_DEPTH = 4
+
+# copied data is dropped from the page cache in steps of this size
+_DROP_CACHE_SIZE = 64 * 1024 * 1024
+
+# progress is shown every percent, and at least this often (seconds) on a terminal, where it is updated in place,
+# respectively in a log
+_PROGRESS_INTERVAL = 0.5
+_PROGRESS_LOG_INTERVAL = 5.0
+
+
+def _preallocate(file: BinaryIO, size: int) -> None:
+    """
+    Allocates the disk space of a file up to size, if the platform and file system support it.
+    Calls fallocate(2) directly: unlike posix_fallocate, it fails on file systems without support instead of
+    writing zeros to every block, which would double the I/O on network shares.
+    :param file: Open file.
+    :param size: Size of the file.
+    """
+    if sys.platform != "linux" or size <= 0:
+        return
+
+    try:
+        _libc = ctypes.CDLL(None, use_errno=True)
+        _libc.fallocate64.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+        _libc.fallocate64(file.fileno(), 0, 0, size)
+    except (AttributeError, OSError, ValueError):
+        pass
+
+
+def _set_pipe_size(fd: int, size: int) -> None:
+    # Larger pipe buffers let splice move more data per call (Linux only)
+    try:
+        import fcntl
+
+        fcntl.fcntl(fd, fcntl.F_SETPIPE_SZ, size)
+    except (ImportError, AttributeError, OSError):
+        pass
+
+
+def _write_views(file: BinaryIO, fd: int | None, offset: int, views: list[memoryview]) -> None:
+    """
+    Writes the views one after another at offset, with a single pwritev call where available.
+    :param file: File to write to, positioned at offset.
+    :param fd: File descriptor of the file, None if it has none.
+    :param offset: Position to write to.
+    :param views: Data to write.
+    """
+    if fd is None or not hasattr(os, "pwritev"):
+        for _view in views:
+            file.write(_view)
+        return
+
+    while views:
+        _written = os.pwritev(fd, views, offset)
+        offset += _written
+        # drop the views written completely and cut the one written partly
+        while views and _written >= len(views[0]):
+            _written -= len(views.pop(0))
+        if views:
+            views[0] = views[0][_written:]
+
+
+def _advise(file: BinaryIO, offset: int, length: int, advice: str) -> None:
+    """
+    Announces the access pattern of a file range to the kernel, if the platform and file support it.
+    :param file: Open file.
+    :param offset: Start of the range.
+    :param length: Length of the range, 0 up to the end of the file.
+    :param advice: Name of the os.POSIX_FADV_* constant.
+    """
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(file.fileno(), offset, length, getattr(os, advice))
+        except (OSError, ValueError):
+            pass
+
 
 class CopyMode(Enum):
     NEW_FILES_ONLY = 1
@@ -26,46 +137,135 @@ class FileStatus(Enum):
 
 
 class DirectoryCache:
+    """
+    Modification times of the copied files, stored in a JSON file plus a journal of the entries added since,
+    one JSON object per line. The journal is folded into the JSON file once it grows too large.
+    """
+
     def __init__(self, file_name: str = ".cache") -> None:
         self._file_name = file_name
+        self._log_file_name = file_name + ".log"
+        self._log = None
+        self._log_entries = 0
+        # size of the complete lines of the journal if it ends with a cut off line, which is removed before appending
+        self._log_valid_size: int | None = None
+        # number of entries in the compacted cache file, the journal is measured against it
+        self._file_entries = 0
         self._cache: dict = self.deserialize_from_file()
+        # entries of set_done, merged into _cache in one update when it is read or written
+        self._pending: list[tuple[str, int]] = []
         self._max_age_in_weeks = 4
+        # compact once the journal has this many times more entries than the cache
+        self._max_log_ratio = 4
+        self._min_log_entries = 1024
+        # reentrant, flush() is also called from the SIGINT handler
+        self._lock = threading.RLock()
 
     # Serialize dictionary to a file
     def serialize_to_file(self):
-        # Convert datetime to UNIX timestamp (milliseconds as uint64)
+        # Convert datetime to UNIX timestamp (nanoseconds, like st_mtime_ns)
         _cutoff = datetime.now(tz=pytz.UTC) - timedelta(weeks=self._max_age_in_weeks)
-        _data_serialized = {key: value for key, value in self._cache.items() if value > _cutoff.timestamp()}
-        with open(self._file_name, "w") as file:
-            json.dump(_data_serialized, file, indent=4)
+        _cutoff_ns = int(_cutoff.timestamp()) * 1_000_000_000
+        with self._lock:
+            self._merge_pending()
+            _data_serialized = {key: value for key, value in self._cache.items() if value > _cutoff_ns}
+            self._file_entries = len(_data_serialized)
+        with open(self._file_name, "wb") as file:
+            file.write(_json_dumps(_data_serialized))
+
+    # Rewrite the cache file (dropping outdated entries) and empty the journal
+    def compact(self) -> None:
+        with self._lock:
+            self.serialize_to_file()
+            if self._log is not None:
+                self._log.close()
+            self._log = open(self._log_file_name, "wb", buffering=io.DEFAULT_BUFFER_SIZE)
+            self._log_entries = 0
+            self._log_valid_size = None
+
+    def _merge_pending(self) -> None:
+        if self._pending:
+            self._cache.update(self._pending)
+            self._pending.clear()
+
+    # Write pending changes to the file
+    def flush(self) -> None:
+        with self._lock:
+            self._merge_pending()
+            if self._log is not None:
+                self._log.flush()
 
     # Deserialize dictionary from a file
     def deserialize_from_file(self):
+        _cache = {}
+
         try:
             if os.path.exists(self._file_name):
-                with open(self._file_name, "r") as file:
-                    return json.load(file)
-        except:
+                with open(self._file_name, "rb") as file:
+                    # Paths are interned, entries of older versions storing float timestamps are dropped
+                    _cache = {sys.intern(key): value for key, value in _json_loads(file.read()).items() if isinstance(value, int)}
+                    self._file_entries = len(_cache)
+        except (OSError, ValueError, AttributeError):
+            # unreadable or not a JSON object
             pass
 
-        return {}
+        # Replay the journal, later entries win
+        try:
+            if os.path.exists(self._log_file_name):
+                with open(self._log_file_name, "rb") as file:
+                    _valid_size = 0
+                    for _line in file:
+                        if not _line.endswith(b"\n"):
+                            # cut off by an interrupted write, even if it parses its value may be incomplete
+                            self._log_valid_size = _valid_size
+                            break
+                        _valid_size += len(_line)
+                        try:
+                            _entry = _json_loads(_line)
+                            _key, _value = _entry["k"], _entry["v"]
+                        except (ValueError, TypeError, KeyError):
+                            # garbage, e.g. from a former cut off line
+                            continue
+                        if isinstance(_key, str) and isinstance(_value, int):
+                            _cache[sys.intern(_key)] = _value
+                            self._log_entries += 1
+        except OSError:
+            pass
 
-    def is_done(self, *, source_file, destination_file: str, copy_mode: CopyMode) -> FileStatus:
-        _ts_cache = self._cache.get(destination_file, 0.0)
+        return _cache
+
+    def is_done(
+        self,
+        *,
+        source_file,
+        destination_file: str,
+        copy_mode: CopyMode,
+        src_stat: os.stat_result | None = None,
+    ) -> FileStatus:
+        if self._pending:
+            with self._lock:
+                self._merge_pending()
+        _ts_cache = self._cache.get(destination_file)
 
         if copy_mode == CopyMode.NEW_FILES_ONLY:
-            if _ts_cache == os.path.getmtime(source_file):
+            if src_stat is None:
+                src_stat = os.stat(source_file)
+            if _ts_cache == src_stat.st_mtime_ns:
                 return FileStatus.CACHED
             else:
                 return FileStatus.NEW
         elif copy_mode == CopyMode.ALL_FILES:
-            if os.path.isfile(destination_file):
-                if _ts_cache == os.path.getmtime(destination_file):
-                    return FileStatus.DONE
-                else:
-                    return FileStatus.PARTLY
-            else:
+            try:
+                _stat_dst = os.stat(destination_file)
+            except FileNotFoundError:
+                return FileStatus.NEW
+
+            if not stat.S_ISREG(_stat_dst.st_mode):
                 return FileStatus.NEW
+            elif _ts_cache == _stat_dst.st_mtime_ns:
+                return FileStatus.DONE
+            else:
+                return FileStatus.PARTLY
 
         if os.path.isfile(destination_file):
             if _ts_cache == os.path.getmtime(source_file):
@@ -76,46 +276,199 @@ class DirectoryCache:
         #     destination_file, 0.0
         # ) == os.path.getmtime(destination_file)
 
-    def set_done(self, *, source_file: str, destination_file: str) -> None:
-        _ts = os.path.getmtime(source_file)
-        os.utime(destination_file, (_ts, _ts))
-        self._cache[destination_file] = _ts
-        self.serialize_to_file()
+    def set_done(self, *, source_file: str, destination_file: str, src_stat: os.stat_result | None = None) -> None:
+        # Integer nanoseconds compare exactly, float seconds can lose precision on the way through JSON.
+        # The stat the copy was based on is stamped, a source changed since then does not look copied.
+        if src_stat is None:
+            src_stat = os.stat(source_file)
+        _ts = src_stat.st_mtime_ns
+        os.utime(destination_file, ns=(_ts, _ts))
+        with self._lock:
+            self._pending.append((destination_file, _ts))
+
+            if self._log is None:
+                self._log = open(self._log_file_name, "ab", buffering=io.DEFAULT_BUFFER_SIZE)
+                if self._log_valid_size is not None:
+                    # new entries must not be appended to a cut off line
+                    self._log.truncate(self._log_valid_size)
+                    self._log.seek(0, io.SEEK_END)
+                    self._log_valid_size = None
+            self._log.write(_json_dumps({"k": destination_file, "v": _ts}) + b"\n")
+            self._log.flush()
+            self._log_entries += 1
+
+            # _cache holds the journal entries as well, only the compacted file bounds the journal
+            if self._log_entries > self._max_log_ratio * max(self._file_entries, self._min_log_entries):
+                self.compact()
 
 
 class RollingMedian:
+    """
+    Median of the last window_size values, kept in two heaps (lower half as max-heap, upper half as min-heap).
+    Entries are (value, insertion index) pairs; those older than the window are removed lazily once they show up
+    at the top of their heap.
+    """
+
     def __init__(self, window_size=10) -> None:
         self.window_size = window_size
-        self.window = deque()
+        self.window = deque(maxlen=window_size)
+        self._lo = []  # lower half, negated entries
+        self._hi = []  # upper half
+        self._size_lo = 0
+        self._size_hi = 0
+        self._count = 0
 
     def add(self, value):
-        self.window.append(value)
+        _entry = (value, self._count)
+        self._count += 1
+
+        if not self._size_lo or _entry <= (-self._lo[0][0], -self._lo[0][1]):
+            heapq.heappush(self._lo, (-value, -_entry[1]))
+            self._size_lo += 1
+        else:
+            heapq.heappush(self._hi, _entry)
+            self._size_hi += 1
+
+        # The full window drops its oldest entry on append, take it out of the halves
+        _oldest = self.window[0] if len(self.window) == self.window_size else None
+        self.window.append(_entry)
 
-        # Remove the oldest value if the window exceeds the specified size
-        if len(self.window) > self.window_size:
-            self.window.popleft()
+        if _oldest is not None:
+            if _oldest <= (-self._lo[0][0], -self._lo[0][1]):
+                self._size_lo -= 1
+            else:
+                self._size_hi -= 1
+            self._prune()
+
+            # Stale entries deep inside the heaps never reach the top, rebuild once they dominate
+            if len(self._lo) + len(self._hi) > 2 * self.window_size:
+                self._rebuild()
+
+        # Keep the lower half equal to or one larger than the upper half
+        while self._size_lo > self._size_hi + 1:
+            _value, _index = heapq.heappop(self._lo)
+            heapq.heappush(self._hi, (-_value, -_index))
+            self._size_lo -= 1
+            self._size_hi += 1
+            self._prune()
+        while self._size_lo < self._size_hi:
+            _value, _index = heapq.heappop(self._hi)
+            heapq.heappush(self._lo, (-_value, -_index))
+            self._size_lo += 1
+            self._size_hi -= 1
+            self._prune()
+
+    def _rebuild(self):
+        _entries = sorted(self.window)
+        _half = (len(_entries) + 1) // 2
+        self._lo = [(-value, -index) for value, index in reversed(_entries[:_half])]
+        self._hi = _entries[_half:]
+        self._size_lo = len(self._lo)
+        self._size_hi = len(self._hi)
+
+    def _prune(self):
+        # Drop entries older than the window from the tops of both heaps
+        _first = self._count - len(self.window)
+        while self._lo and -self._lo[0][1] < _first:
+            heapq.heappop(self._lo)
+        while self._hi and self._hi[0][1] < _first:
+            heapq.heappop(self._hi)
 
     def median(self):
         # Return the median of the current window
         if not self.window:
             return 0
-        return np.median(self.window)
+        if self._size_lo > self._size_hi:
+            return -self._lo[0][0]
+        return (-self._lo[0][0] + self._hi[0][0]) / 2
+
+
+class MappedFile:
+    """
+    Read-only random access to an open file, memory mapped if the file supports it and read via the file handle otherwise.
+    """
+
+    def __init__(self, file: BinaryIO, size: int) -> None:
+        self._file = file
+        self._mmap = None
+        self._buffer = bytearray()
+
+        if size > 0:
+            try:
+                self._mmap = mmap.mmap(file.fileno(), size, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                # e.g. file like objects or network shares which can not be mapped
+                pass
+
+    def read(self, offset: int, size: int) -> bytes:
+        # Slicing the mapping copies at memcpy speed, the resulting bytes compare with a single memcmp
+        if self._mmap is not None:
+            return self._mmap[offset : offset + size]
+
+        self._file.seek(offset)
+        return self._file.read(size)
+
+    def view(self, offset: int, size: int) -> memoryview:
+        # Zero copy view for large ranges, without mapping it is read into a buffer reused by the next call
+        if self._mmap is not None:
+            return memoryview(self._mmap)[offset : offset + size]
+
+        if len(self._buffer) < size:
+            # a new buffer, views of the old one may still be alive
+            self._buffer = bytearray(size)
+        self._file.seek(offset)
+        _view = memoryview(self._buffer)[:size]
+        return _view[: self._file.readinto(_view)]
+
+    def advise(self, advice: str, offset: int = 0, length: int = 0) -> None:
+        """
+        Tells the OS how the mapping will be accessed, ignored without mapping or if the advice is not supported.
+        :param advice: Name of the mmap.MADV_* constant.
+        :param offset: Start of the range, rounded down to a page.
+        :param length: Length of the range, 0 for up to the end.
+        """
+        if self._mmap is None or not hasattr(mmap, advice):
+            return
+
+        _start = offset - offset % mmap.PAGESIZE
+        _length = length + offset - _start if length else len(self._mmap) - _start
+        try:
+            self._mmap.madvise(getattr(mmap, advice), _start, min(_length, len(self._mmap) - _start))
+        except (OSError, ValueError):
+            pass
+
+    def close(self) -> None:
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # still referenced by a view, the mapping is released together with it
+                pass
 
 
 class Copier:
-    def __init__(self, block_size=2048, dry_run: bool = False) -> None:
-        self.__abort = False
+    def __init__(self, block_size=2048, dry_run: bool = False, jobs: int = 1, verify: bool = False) -> None:
+        self.__abort = threading.Event()
         self.__dry_run = dry_run
+        self.__verify = verify
         self.__block_size = block_size
-        self.__transfer_rate_median = RollingMedian()
+        self.__jobs = jobs
+        self.__thread_local = threading.local()
+        self.__created_dirs: set[str] = set()
+        # Progress is written to stderr by all copying threads. Updated in place on a terminal, unless several copies
+        # run in parallel: their lines would overwrite each other and the status lines of the other copies.
+        self.__progress_lock = threading.Lock()
+        self.__progress_in_place = jobs == 1 and sys.stderr.isatty()
         _path = os.path.dirname(__file__)
         self.__directory_cache = DirectoryCache(os.path.join(_path, ".cache"))
 
         def signal_handler(sig, frame):
-            self.__abort = True
+            self.__abort.set()
+            self.__directory_cache.flush()
             print("\nCopying interrupted by user.")
 
         signal.signal(signal.SIGINT, signal_handler)
+        atexit.register(self.__directory_cache.flush)
 
         if dry_run:
             print("\nDry run.")
@@ -139,42 +492,133 @@ class Copier:
     ) -> int:
         """
         Finds the position in the destination file where the content starts to be different (mostly zero bytes) compared to the source file.
+        Both files are memory mapped. The damaged part is expected at the end: it is bracketed by probing blocks backwards
+        from the end in growing steps and bisecting, then compared in tiles from there. With verify the files are compared
+        in tiles from the start. The result is the offset of the first differing byte.
         :param source_file: File handle to the source file.
         :param destination_file: File handle to the destination file.
         :return: Position (offset) to resume writing.
         """
 
         _block_size = min(total_size_src, self.__block_size)
-
-        def is_block_different(f_src: BinaryIO, f_dst: BinaryIO, offset: int) -> bool:
-            f_src.seek(offset)
-            f_dst.seek(offset)
-
-            block_src = f_src.read(_block_size)
-            block_dst = f_dst.read(_block_size)
-            return block_src != block_dst
-
-        def is_file_equal(f_src: BinaryIO, f_dst: BinaryIO, file_size: int) -> bool:
-            _mismatch_start = is_block_different(f_src, f_dst, 0)
-            _mismatch_end = is_block_different(f_src, f_dst, file_size - _block_size)
-            return not _mismatch_start and not _mismatch_end
-
-        start = 0
-        end = total_size_dst
-
-        with open(destination_file, "rb") as f_dst:
-            with open(source_file, "rb") as f_src:
-                if not is_file_equal(f_src, f_dst, total_size_dst):
-                    while start + 1 < end:
-                        mid = (start + end) // 2
-                        if is_block_different(f_src, f_dst, mid):
-                            end = mid
-                        else:
-                            start = mid
-                elif total_size_src > total_size_dst:
-                    start = total_size_dst
+        _tile_size = 64 * 1024 * 1024
+
+        def is_zero_block(block: bytes) -> bool:
+            _words = len(block) // 8
+            return not np.frombuffer(block, dtype="<u8", count=_words).any() and not any(block[_words * 8 :])
+
+        # Results of the blocks compared so far by offset, the equality check, gallop and bisection may probe the same block
+        _probed: dict[int, bool] = {}
+
+        def is_block_different(v_src: MappedFile, v_dst: MappedFile, offset: int) -> bool:
+            _different = _probed.get(offset)
+            if _different is None:
+                _block_dst = v_dst.read(offset, _block_size)
+                # A zeroed block is what an interrupted copy into a preallocated file leaves, it does not prove equality
+                # and is counted as different without reading the source. A copy always writes the first block, which
+                # is compared bytewise: equal files may start with zeros (disk images, padded headers).
+                _different = (offset > 0 and is_zero_block(_block_dst)) or _block_dst != v_src.read(offset, _block_size)
+                _probed[offset] = _different
+            return _different
+
+        def is_file_equal(v_src: MappedFile, v_dst: MappedFile, file_size: int) -> bool:
+            return not is_block_different(v_src, v_dst, 0) and not is_block_different(v_src, v_dst, max(0, file_size - _block_size))
+
+        def first_different_byte(block_src, block_dst) -> int:
+            _diff = np.not_equal(np.frombuffer(block_src, dtype=np.uint8), np.frombuffer(block_dst, dtype=np.uint8))
+            if not _diff.size:
+                return -1
+            _index = int(_diff.argmax())
+            return _index if _diff[_index] else -1
+
+        def find_damaged_suffix(v_src: MappedFile, v_dst: MappedFile, size: int) -> int:
+            # Gallop backwards from the end until a block matches, then bisect between it and the nearest different block
+            if not _block_size or size < 2 * _block_size:
+                return 0
+
+            _good = _bad = -1
+            # Probes stay aligned to the block size, starting with the last complete block
+            _step = _block_size
+            _offset = (size - _block_size) // _block_size * _block_size
+            while _offset > 0:
+                # Request the next probe while this one is compared, the gallop stops at the first matching block
+                if _offset > _step:
+                    for _v in v_src, v_dst:
+                        _v.advise("MADV_WILLNEED", _offset - _step, _block_size)
+                if not is_block_different(v_src, v_dst, _offset):
+                    _good = _offset
+                    break
+                _bad = _offset
+                _offset -= _step
+                _step *= 2
+
+            if _good < 0 or _bad < 0:
+                # no matching block, or the difference is not at the end
+                return 0
+
+            while _bad - _good > _block_size:
+                _middle = (_good + _bad) // 2 // _block_size * _block_size
+                if is_block_different(v_src, v_dst, _middle):
+                    _bad = _middle
+                else:
+                    _good = _middle
+            return _good
+
+        def find_first_difference(v_src: MappedFile, v_dst: MappedFile, start: int, size: int) -> int:
+            # Compare tile by tile as 64 bit words with NumPy, stop at the first tile containing a differing word
+            for _offset in range(start, size, _tile_size):
+                _length = min(_tile_size, size - _offset)
+                _words = _length // 8
+                _view_src = v_src.view(_offset, _length)
+                _view_dst = v_dst.view(_offset, _length)
+
+                _diff = np.not_equal(
+                    np.frombuffer(_view_src, dtype="<u8", count=_words),
+                    np.frombuffer(_view_dst, dtype="<u8", count=_words),
+                )
+                _index = int(_diff.argmax()) if _words else 0
+                if _words and _diff[_index]:
+                    # Refine to the byte within the differing word
+                    _start = _index * 8
+                    return _offset + _start + first_different_byte(_view_src[_start : _start + 8], _view_dst[_start : _start + 8])
+
+                # Bytes behind the last full word
+                _index = first_different_byte(_view_src[_words * 8 :], _view_dst[_words * 8 :])
+                if _index >= 0:
+                    return _offset + _words * 8 + _index
+            return -1
+
+        with open(destination_file, "rb") as f_dst, open(source_file, "rb") as f_src:
+            try:
+                # Probe whole file system blocks, the OS reads them completely anyway
+                _block_size = min(total_size_src, max(_block_size, os.fstat(f_dst.fileno()).st_blksize))
+            except (OSError, ValueError):
+                pass
+            v_src = MappedFile(f_src, total_size_src)
+            v_dst = MappedFile(f_dst, total_size_dst)
+            try:
+                # With verify equal probes prove nothing, the files are compared completely
+                if self.__verify or not is_file_equal(v_src, v_dst, total_size_dst):
+                    _size = min(total_size_src, total_size_dst)
+                    _start = 0
+                    if not self.__verify:
+                        # Single blocks spread over the files, read ahead would only fetch pages never compared
+                        for _v in v_src, v_dst:
+                            _v.advise("MADV_RANDOM")
+                        _start = find_damaged_suffix(v_src, v_dst, _size)
+                    for _v in v_src, v_dst:
+                        _v.advise("MADV_SEQUENTIAL", _start)
+                    start = find_first_difference(v_src, v_dst, _start, _size)
+                    # Equal up to the end of the shorter file: continue a shorter destination, cut a longer one
+                    if start < 0 and total_size_src != total_size_dst:
+                        start = _size
+                elif total_size_src != total_size_dst:
+                    start = min(total_size_src, total_size_dst)
                 else:
                     start = -1
+            finally:
+                v_src.close()
+                v_dst.close()
 
         return start
 
@@ -182,43 +626,318 @@ class Copier:
         self.__copy_directory_internal(src, dest, CopyMode.NEW_FILES_ONLY)
         self.__copy_directory_internal(src, dest, CopyMode.ALL_FILES)
 
-    def __copy_directory_internal(self, src: str, dest: str, copy_mode: CopyMode):
-        try:
-            for _root, _, _files in os.walk(src):
-                _rel_path_src = os.path.relpath(_root, start=src)
+    @staticmethod
+    def _walk_files(src: str) -> Iterator[tuple[os.DirEntry, str]]:
+        """
+        Walks the directory tree below src (top down, like os.walk) and keeps the directory entries of the files,
+        which carry their stat information.
+        :param src: Path to the directory.
+        :return: Yields the directory entry of each file and its directory relative to src, ending with a separator.
+        """
+        _stack = [(src, "")]
 
-                for _file in _files:
-                    if self.__abort:
-                        return
+        while _stack:
+            _dir, _rel_dir = _stack.pop()
+            _sub_dirs = []
 
-                    _file_path_src = os.path.normpath(os.path.join(_root, _file))
-                    _file_path_dest = os.path.normpath(os.path.join(dest, _rel_path_src, _file))
+            try:
+                with os.scandir(_dir) as _entries:
+                    for _entry in _entries:
+                        if _entry.is_dir(follow_symlinks=False):
+                            _sub_dirs.append((_entry.path, _rel_dir + _entry.name + os.sep))
+                        elif _entry.is_file():
+                            yield _entry, _rel_dir
+            except OSError:
+                # unreadable directory, skipped like os.walk does
+                continue
 
-                    _src_file_rel = os.path.normpath(os.path.join(_rel_path_src, _file))
-                    _file_status = self.__directory_cache.is_done(
-                        source_file=_file_path_src,
-                        destination_file=_file_path_dest,
-                        copy_mode=copy_mode,
-                    )
+            _stack.extend(reversed(_sub_dirs))
 
-                    if _file_status == FileStatus.CACHED:
-                        print(f"File cached: {_src_file_rel}")
-                        continue
+    def __copy_directory_internal(self, src: str, dest: str, copy_mode: CopyMode):
+        try:
+            _dest = os.path.join(os.path.normpath(dest), "")
+            _files = []
+
+            for _entry, _rel_dir in self._walk_files(os.path.normpath(src)):
+                if self.__abort.is_set():
+                    return
+
+                _src_file_rel = _rel_dir + _entry.name
+                _file_path_src = _entry.path
+                _file_path_dest = _dest + _src_file_rel
+
+                _stat_src = _entry.stat()
+                _file_status = self.__directory_cache.is_done(
+                    source_file=_file_path_src,
+                    destination_file=_file_path_dest,
+                    copy_mode=copy_mode,
+                    src_stat=_stat_src,
+                )
+
+                if _file_status == FileStatus.CACHED and self.__verify:
+                    # Compared in this pass, the next pass then finds it done
+                    _files.append((_file_path_src, _file_path_dest))
+                elif _file_status == FileStatus.CACHED:
+                    print(f"File cached: {_src_file_rel}")
+                    continue
+
+                elif _file_status == FileStatus.NEW:
+                    # print(f"Copy new file: {_src_file_rel}")
+                    _files.append((_file_path_src, _file_path_dest))
+                elif _file_status == FileStatus.PARTLY:
+                    # print(f"Check existing file: {_src_file_rel}")
+                    _files.append((_file_path_src, _file_path_dest))
+                elif _file_status == FileStatus.DONE:
+                    print(f"File done: {_src_file_rel}")
+                else:
+                    print(f"File status {_file_status} not implemented yet")
 
-                    elif _file_status == FileStatus.NEW:
-                        # print(f"Copy new file: {_src_file_rel}")
-                        self.copy_file(src=_file_path_src, dst=_file_path_dest)
-                    elif _file_status == FileStatus.PARTLY:
-                        # print(f"Check existing file: {_src_file_rel}")
-                        self.copy_file(src=_file_path_src, dst=_file_path_dest)
-                    elif _file_status == FileStatus.DONE:
-                        print(f"File done: {_src_file_rel}")
-                    else:
-                        print(f"File status {_file_status} not implemented yet")
+            # Sorted, the order of directory entries depends on the file system
+            _files.sort(key=lambda _file: _file[0])
+            self.__copy_files(_files)
 
         except Exception as e:
             print(f"An error has occurred: {e}")
             traceback.print_exc()
+        finally:
+            self.__directory_cache.flush()
+
+    def __copy_files(self, files: list[tuple[str, str]]) -> None:
+        """
+        Copies the files with up to jobs copies running in parallel, started in the given order.
+        :param files: Source and destination path of each file.
+        """
+        with ThreadPoolExecutor(max_workers=self.__jobs) as _executor:
+            _pending = {_executor.submit(self.copy_file, src=_src, dst=_dst) for _src, _dst in files}
+            try:
+                while _pending:
+                    # Wait with a timeout which lets the SIGINT handler run on every platform
+                    _done, _pending = wait(_pending, timeout=0.5, return_when=FIRST_COMPLETED)
+                    for _future in _done:
+                        _future.result()
+            finally:
+                for _future in _pending:
+                    _future.cancel()
+
+    def __copy_buffers(self) -> list[mmap.mmap]:
+        # Buffers of the read/write loop, allocated once per copying thread and reused for all its files.
+        # Anonymous mappings are page aligned.
+        _buffers = getattr(self.__thread_local, "buffers", None)
+        if _buffers is None:
+            _buffers = [mmap.mmap(-1, _CHUNK_SIZE) for _ in range(_PIPELINE_DEPTH)]
+            self.__thread_local.buffers = _buffers
+        return _buffers
+
+    def __show_progress(self, line: str | None) -> None:
+        """
+        Writes a progress line to stderr, on a terminal it replaces the previous one.
+        :param line: Progress line, None to end the line of a finished copy.
+        """
+        with self.__progress_lock:
+            if line is None:
+                if self.__progress_in_place:
+                    sys.stderr.write("\n")
+            elif self.__progress_in_place:
+                # padded to overwrite a longer previous line
+                sys.stderr.write(f"\r{line:<79}")
+            else:
+                sys.stderr.write(f"{line}\n")
+            sys.stderr.flush()
+
+    def _splice_range(self, fd_src: int, fd_dst: int, offset: int) -> Iterator[int]:
+        """
+        Copies the source file from offset up to its end into a pipe with splice, without passing user space.
+        :param fd_src: File descriptor of the source file.
+        :param fd_dst: File descriptor of the destination pipe.
+        :param offset: Position to start copying from.
+        :return: Yields the number of bytes copied per chunk.
+        """
+        _pipe_size = 1024 * 1024
+
+        _set_pipe_size(fd_dst, _pipe_size)
+        while not self.__abort.is_set():
+            _moved = os.splice(fd_src, fd_dst, _pipe_size, offset_src=offset)
+            if _moved == 0:
+                return
+            offset += _moved
+            yield _moved
+
+    def _copy_range(self, f_src: BinaryIO, f_dst: BinaryIO, offset: int) -> Iterator[int]:
+        """
+        Copies the source file from offset up to its end to the same offset of the destination file.
+        The bytes are moved inside the kernel (sendfile, copy_file_range) if supported, otherwise by a read/write loop
+        which reads ahead the next chunks while the current one is written.
+        :param f_src: File handle to the source file.
+        :param f_dst: File handle to the destination file, positioned at offset.
+        :param offset: Position to start copying from.
+        :return: Yields the number of bytes copied per chunk.
+        """
+        try:
+            _fd_src = f_src.fileno()
+            _fd_dst = f_dst.fileno()
+            f_dst.flush()
+        except (OSError, ValueError):
+            # no OS level file (e.g. file like object)
+            _fd_src = _fd_dst = None
+
+        if _fd_src is not None and hasattr(os, "splice") and stat.S_ISFIFO(os.fstat(_fd_dst).st_mode):
+            try:
+                for _moved in self._splice_range(_fd_src, _fd_dst, offset):
+                    offset += _moved
+                    yield _moved
+                return
+            except OSError as e:
+                if e.errno not in _KERNEL_COPY_UNSUPPORTED:
+                    raise
+
+        if _fd_src is not None and hasattr(os, "sendfile"):
+            try:
+                while not self.__abort.is_set():
+                    _sent = os.sendfile(_fd_dst, _fd_src, offset, _CHUNK_SIZE)
+                    if _sent == 0:
+                        return
+                    offset += _sent
+                    yield _sent
+                return
+            except OSError as e:
+                if e.errno not in _KERNEL_COPY_UNSUPPORTED:
+                    raise
+
+        if _fd_src is not None and hasattr(os, "copy_file_range"):
+            try:
+                while not self.__abort.is_set():
+                    _copied = os.copy_file_range(_fd_src, _fd_dst, _CHUNK_SIZE, offset, offset)
+                    if _copied == 0:
+                        return
+                    offset += _copied
+                    yield _copied
+                return
+            except OSError as e:
+                if e.errno not in _KERNEL_COPY_UNSUPPORTED:
+                    raise
+
+        # Pipeline the read/write loop: a reader thread fills free buffers while the previous ones are written
+        _buffers: queue.Queue = queue.Queue()
+        for _buffer in self.__copy_buffers():
+            _buffers.put(_buffer)
+        _chunks: queue.Queue = queue.Queue()
+        _stop = threading.Event()
+
+        def reader() -> None:
+            try:
+                # Read at explicit offsets where possible, without moving the file position
+                _pread = _fd_src is not None and hasattr(os, "preadv")
+                _position = offset
+                if not _pread:
+                    f_src.seek(offset)
+                while not _stop.is_set():
+                    try:
+                        _buffer = _buffers.get(timeout=0.1)
+                    except queue.Empty:
+                        continue
+                    if _pread:
+                        _length = os.preadv(_fd_src, [_buffer], _position)
+                        _position += _length
+                    else:
+                        _length = f_src.readinto(_buffer)
+                    _chunks.put((_buffer, _length))
+                    if not _length:
+                        return
+            except Exception as e:
+                _chunks.put((None, e))
+
+        _reader = threading.Thread(target=reader, daemon=True)
+        _reader.start()
+
+        try:
+            # A pipe is written in order through the file object, files at explicit offsets
+            if f_dst.seekable():
+                f_dst.seek(offset)
+            else:
+                _fd_dst = None
+            while not self.__abort.is_set():
+                # Take all chunks read ahead so far, they are written together by one pwritev
+                _ready = [_chunks.get()]
+                while _ready[-1][0] is not None and _ready[-1][1] and len(_ready) < _PIPELINE_DEPTH:
+                    try:
+                        _ready.append(_chunks.get_nowait())
+                    except queue.Empty:
+                        break
+                _filled = [(_buffer, _length) for _buffer, _length in _ready if _buffer is not None and _length]
+                if _filled:
+                    _write_views(f_dst, _fd_dst, offset, [memoryview(_buffer)[:_length] for _buffer, _length in _filled])
+                for _buffer, _length in _filled:
+                    offset += _length
+                    _buffers.put(_buffer)
+                    yield _length
+
+                _buffer, _length = _ready[-1]
+                if _buffer is None:
+                    raise _length
+                if not _length:
+                    break
+        finally:
+            _stop.set()
+            _reader.join()
+
+    def __copy_stream(self, f_src: BinaryIO, f_dst: BinaryIO, resume_position: int, total_size_src: int) -> int:
+        """
+        Copies the remainder of the source file from the resume position and shows the progress.
+        :param f_src: File handle to the source file.
+        :param f_dst: File handle to the destination file, positioned at the resume position.
+        :param resume_position: Position to start copying from.
+        :param total_size_src: Size of the source file.
+        :return: Size of the destination file copied so far, less than the source size if interrupted.
+        """
+        copied_size = resume_position
+        start_time = time.monotonic()
+        transfer_rate_median = RollingMedian()
+
+        # Progress is shown every percent (at least 1 MiB) or progress interval, the loop only compares against the next
+        # byte count and time to report
+        progress_step = max(1024 * 1024, total_size_src // 100)
+        progress_interval = _PROGRESS_INTERVAL if self.__progress_in_place else _PROGRESS_LOG_INTERVAL
+        progress_shown = False
+        last_shown_size = copied_size
+        next_progress_size = min(copied_size + progress_step, total_size_src)
+
+        cached_size = resume_position
+        for _length_chunk in self._copy_range(f_src, f_dst, resume_position):
+            copied_size += _length_chunk
+
+            # The copied data is not read again, keep it from pushing other data out of the page cache
+            if copied_size - cached_size >= _DROP_CACHE_SIZE:
+                _advise(f_src, cached_size, copied_size - cached_size, "POSIX_FADV_DONTNEED")
+                _advise(f_dst, cached_size, copied_size - cached_size, "POSIX_FADV_DONTNEED")
+                cached_size = copied_size
+
+            _now = time.monotonic()
+            if (copied_size >= next_progress_size or _now - start_time >= progress_interval) and not self.__abort.is_set():
+                progress = (copied_size * 100) // total_size_src
+                elapsed_time = _now - start_time
+                transfer_rate = ((copied_size - last_shown_size) / (1024 * 1024)) / elapsed_time if elapsed_time > 0 else 0
+                transfer_rate_median.add(transfer_rate)
+                transfer_rate = transfer_rate_median.median()
+
+                remaining_time = (total_size_src - copied_size) / (transfer_rate * 1024 * 1024) if transfer_rate > 0 else float("inf")
+
+                if remaining_time == float("inf"):
+                    remaining = "--:--"
+                else:
+                    remaining_minutes, remaining_seconds = divmod(int(remaining_time), 60)
+                    remaining = f"{remaining_minutes:02d}:{remaining_seconds:02d}"
+
+                last_shown_size = copied_size
+                next_progress_size = min(copied_size + progress_step, total_size_src)
+                start_time = _now
+
+                self.__show_progress(f"Progress: {progress:3d}% | Transfer rate: {transfer_rate:5.2f} MB/s | Remaining time: {remaining}")
+                progress_shown = True
+
+        if progress_shown:
+            self.__show_progress(None)
+
+        return copied_size
 
     def copy_file(self, *, src: str, dst: str):
         """
@@ -226,29 +945,49 @@ class Copier:
         :param source_file: Path to the source file.
         :param destination_file: Path to the destination file.
         """
-        total_size_src = os.path.getsize(src)
+        if self.__abort.is_set():
+            return
+
+        # Stat when the copy starts, the stat of the directory walk may be long outdated by then
+        _stat_src = os.stat(src)
+        total_size_src = _stat_src.st_size
+        try:
+            _stat_dst = os.stat(dst)
+        except FileNotFoundError:
+            _stat_dst = None
+        # Pipes, e.g. --dst >(ssh host "cat > file"), are written from the start and not cached
+        _is_pipe = _stat_dst is not None and stat.S_ISFIFO(_stat_dst.st_mode)
 
         # Determine the resume position
-        if os.path.exists(dst):
-            total_size_dst = os.path.getsize(dst)
-            print(f"Files exists remotely, find resume position {dst}")
-            resume_position = self._find_resume_position(
-                source_file=src,
-                destination_file=dst,
-                total_size_src=total_size_src,
-                total_size_dst=total_size_dst,
-            )
+        if _is_pipe:
+            print(f"Destination is a pipe {dst}")
+            resume_position = 0
+        elif _stat_dst is not None:
+            total_size_dst = _stat_dst.st_size
+            # set_done gives finished copies the modification time of their source, interrupted ones keep a later one
+            if not self.__verify and total_size_dst == total_size_src and _stat_dst.st_mtime_ns == _stat_src.st_mtime_ns:
+                resume_position = -1
+            else:
+                print(f"Files exists remotely, find resume position {dst}")
+                resume_position = self._find_resume_position(
+                    source_file=src,
+                    destination_file=dst,
+                    total_size_src=total_size_src,
+                    total_size_dst=total_size_dst,
+                )
         else:
             print(f"Files does not exist remotely {dst}")
             resume_position = 0
 
         if resume_position < 0:
-            self.__directory_cache.set_done(source_file=src, destination_file=dst)
+            self.__directory_cache.set_done(source_file=src, destination_file=dst, src_stat=_stat_src)
             print("Files are equal")
             return
         if resume_position == 0:
             pass
             # print(f"File is new: {os.path.basename(dst)}")
+        elif resume_position == total_size_src:
+            print(f"File is longer than the source and is cut: {os.path.basename(dst)}")
         else:
             _percentage = int((resume_position * 100) // total_size_src)
             print(f"File is incomplete ({_percentage:02d}%): {os.path.basename(dst)}")
@@ -256,54 +995,48 @@ class Copier:
         if self.__dry_run:
             return
 
-        # Ensure the destination directory exists
+        # Ensure the destination directory exists, once per directory
         destination_dir = os.path.dirname(dst)
-        if not os.path.exists(destination_dir):
-            os.makedirs(destination_dir)
+        if destination_dir and destination_dir not in self.__created_dirs:
+            os.makedirs(destination_dir, exist_ok=True)
+            self.__created_dirs.add(destination_dir)
 
         print(f"File {os.path.basename(src)} mismatch. Start copying from {resume_position=} {total_size_src=}")
         # return
 
+        if resume_position == 0 and total_size_src <= _FAST_COPY_MAX_SIZE and not _is_pipe:
+            # New file which is copied quickly enough to not need progress or interruption, leave it to the OS fast path
+            shutil.copyfile(src, dst)
+            self.__directory_cache.set_done(source_file=src, destination_file=dst, src_stat=_stat_src)
+            print(f"File copied successfully: {os.path.basename(src)}.")
+            return
+
         with open(src, "rb") as f_src, open(dst, "r+b" if resume_position > 0 else "wb") as f_dst:
-            # Skip to the resume position in both files
+            # Skip to the resume position in the destination file, the source is read at explicit offsets
             if resume_position > 0:
-                f_src.seek(resume_position)
                 f_dst.seek(resume_position)
 
-            # Copy the remainder of the file with progress
-            copied_size = resume_position
-            last_shown_progress = None
-            start_time = time.time()
-            copied_size_since_last_progress_shown = 0
-
-            while not self.__abort:
-                chunk = f_src.read(5 * 1024 * 1024)  # Read in 5 MB chunks
-                if not chunk:
-                    break
-                f_dst.write(chunk)
-                _length_chunk = len(chunk)
-                copied_size += _length_chunk
-                progress = (copied_size * 100) // total_size_src
-                copied_size_since_last_progress_shown += _length_chunk
+            # Reserve the space of a new file at once instead of extending it with every write
+            if resume_position == 0 and not _is_pipe:
+                _preallocate(f_dst, total_size_src)
 
-                if progress != last_shown_progress and not self.__abort:
-                    elapsed_time = time.time() - start_time
-                    transfer_rate = (copied_size_since_last_progress_shown / (1024 * 1024)) / elapsed_time if elapsed_time > 0 else 0
-                    self.__transfer_rate_median.add(transfer_rate)
-                    transfer_rate = self.__transfer_rate_median.median()
+            # The source is read once from front to back
+            _advise(f_src, resume_position, 0, "POSIX_FADV_SEQUENTIAL")
 
-                    remaining_time = (total_size_src - copied_size) / (transfer_rate * 1024 * 1024) if transfer_rate > 0 else float("inf")
+            copied_size = self.__copy_stream(f_src, f_dst, resume_position, total_size_src)
 
-                    remaining_minutes, remaining_seconds = divmod(remaining_time, 60)
+            # The file ends where copying stopped, without a preallocated remainder or the excess of a longer destination
+            if not _is_pipe:
+                f_dst.truncate(copied_size)
 
-                    last_shown_progress = progress
-                    start_time = time.time()
-                    copied_size_since_last_progress_shown = 0
+            # The copied data is not read again, drop it from the page cache
+            f_dst.flush()
+            _advise(f_src, resume_position, 0, "POSIX_FADV_DONTNEED")
+            _advise(f_dst, resume_position, 0, "POSIX_FADV_DONTNEED")
 
-                    print(f"Progress: {progress:3d}% | Transfer rate: {transfer_rate:5.2f} MB/s | Remaining time: {int(remaining_minutes):02d}:{int(remaining_seconds):02d}")
-
-        if not self.__abort:
-            self.__directory_cache.set_done(source_file=src, destination_file=dst)
+        if not self.__abort.is_set():
+            if not _is_pipe:
+                self.__directory_cache.set_done(source_file=src, destination_file=dst, src_stat=_stat_src)
             print(f"File copied successfully: {os.path.basename(src)}.")
 
 
@@ -324,6 +1057,14 @@ class Copier:
 #             print(f"An error occurred: {e}")
 
 
+def positive_int(value: str) -> int:
+    # argparse type for counts of at least 1
+    _number = int(value)
+    if _number < 1:
+        raise argparse.ArgumentTypeError(f"{value} is not a positive number")
+    return _number
+
+
 def parse_commandline() -> None:
     global _args
 
@@ -348,9 +1089,27 @@ def parse_commandline() -> None:
         action="store_true",
     )
 
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        dest="jobs",
+        required=False,
+        type=positive_int,
+        default=1,
+        help="number of files copied in parallel (default: 1)",
+    )
+
+    parser.add_argument(
+        "--verify",
+        dest="verify",
+        required=False,
+        help="compare existing files completely, also cached ones and those with the same size and modification time as the source",
+        action="store_true",
+    )
+
     return parser.parse_args()
 
 
 if __name__ == "__main__":
     _args = parse_commandline()
-    Copier(dry_run=_args.dry).copy(src=_args.src, dst=_args.dst)
+    Copier(dry_run=_args.dry, jobs=_args.jobs, verify=_args.verify).copy(src=_args.src, dst=_args.dst)
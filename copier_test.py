@@ -1,8 +1,16 @@
 from copier import *
+import copier
 import unittest
 from unittest.mock import patch
 from fs.memoryfs import MemoryFS
 from parameterized import parameterized
+from types import SimpleNamespace
+from contextlib import contextmanager
+import random
+import stat
+import tempfile
+
+_os_stat = os.stat
 
 
 class TestWithVirtualFileSystem(unittest.TestCase):
@@ -15,12 +23,14 @@ class TestWithVirtualFileSystem(unittest.TestCase):
         self.exists_patcher = patch("os.path.exists", new=self._mock_exists)
         self.mtime_patcher = patch("os.path.getmtime", new=self._mock_getmtime)
         self.utime_patcher = patch("os.utime", new=self._mock_utime)
+        self.stat_patcher = patch("os.stat", new=self._mock_stat)
 
         # Start the patchers
         self.open_patcher.start()
         self.exists_patcher.start()
         self.mtime_patcher.start()
         self.utime_patcher.start()
+        self.stat_patcher.start()
 
     def tearDown(self):
         # Stop the patchers
@@ -28,6 +38,7 @@ class TestWithVirtualFileSystem(unittest.TestCase):
         self.exists_patcher.stop()
         self.mtime_patcher.stop()
         self.utime_patcher.stop()
+        self.stat_patcher.stop()
 
         # Close the virtual file system
         self.vfs.close()
@@ -55,7 +66,16 @@ class TestWithVirtualFileSystem(unittest.TestCase):
         # Get the modified time from the virtual file system
         return self.vfs.getinfo(path, namespaces="details").modified.timestamp()
 
-    def _mock_utime(self, path, times: tuple[int, int] | tuple[float, float] | None = None) -> float:
+    def _mock_stat(self, path, *args, **kwargs):
+        """Return a mocked os.stat() that uses the virtual file system for its files."""
+        if not isinstance(path, str) or not self.vfs.exists(path):
+            return _os_stat(path, *args, **kwargs)
+        _info = self.vfs.getinfo(path, namespaces=["details"])
+        _mode = stat.S_IFDIR if _info.is_dir else stat.S_IFREG
+        _mtime = _info.modified.timestamp()
+        return SimpleNamespace(st_mode=_mode, st_size=_info.size, st_mtime=_mtime, st_mtime_ns=int(_mtime * 1_000_000_000))
+
+    def _mock_utime(self, path, times: tuple[int, int] | tuple[float, float] | None = None, *, ns: tuple[int, int] | None = None) -> float:
         """Return a mocked os.utime() that uses the virtual file system."""
         if not self.vfs.exists(path):
             raise FileNotFoundError(f"No such file or directory: '{path}'")
@@ -65,15 +85,15 @@ class TestWithVirtualFileSystem(unittest.TestCase):
     @parameterized.expand(
         [
             ("0", 0, 10, 0),
-            ("1", 1, 9, 0),
-            ("2", 2, 8, 0),
-            ("3", 3, 7, 1),
-            ("4", 4, 6, 2),
-            ("5", 5, 5, 3),
-            ("6", 6, 6, 4),
-            ("7", 7, 7, 5),
-            ("8", 8, 8, 6),
-            ("9", 9, 9, 7),
+            ("1", 1, 9, 1),
+            ("2", 2, 8, 2),
+            ("3", 3, 7, 3),
+            ("4", 4, 6, 4),
+            ("5", 5, 5, 5),
+            ("6", 6, 6, 6),
+            ("7", 7, 7, 7),
+            ("8", 8, 8, 8),
+            ("9", 9, 9, 9),
             ("10", 10, 0, -1),  # complete
         ]
     )
@@ -91,6 +111,46 @@ class TestWithVirtualFileSystem(unittest.TestCase):
         _pos = c._find_resume_position(source_file="test_src.bin", destination_file="test_dst.bin", total_size_src=10, total_size_dst=10)
         assert _pos == expected_result, f"Result: {_pos=}"
 
+    @parameterized.expand(
+        [
+            ("empty", b"", b"", -1),
+            ("empty source", b"", b"\x00\x00", 0),
+            ("empty destination", b"\x01\x02", b"", 0),
+            ("longer destination", b"\x01\x02\x03\x04", b"\x01\x02\x03\x04\x05\x06", 4),
+            ("longer destination different", b"\x01\x02\x03\x04", b"\x01\x02\x00\x04\x05\x06", 2),
+        ]
+    )
+    def test_find_resume_position_sizes(self, _, data_src, data_dst, expected_result):
+        with open("test_src.bin", "wb") as f_src:
+            f_src.write(data_src)
+        with open("test_dst.bin", "wb") as f_dst:
+            f_dst.write(data_dst)
+
+        c = Copier(block_size=2)
+        _pos = c._find_resume_position(
+            source_file="test_src.bin", destination_file="test_dst.bin", total_size_src=len(data_src), total_size_dst=len(data_dst)
+        )
+        assert _pos == expected_result, f"Result: {_pos=}"
+
+    def test_find_resume_position_verify(self):
+        # a damaged block in the middle is only found by the full comparison
+        _src = bytes(range(1, 65))
+        _dst = _src[:10] + b"\x00\x00" + _src[12:60] + b"\x00\x00\x00\x00"
+        with open("test_src.bin", "wb") as f_src:
+            f_src.write(_src)
+        with open("test_dst.bin", "wb") as f_dst:
+            f_dst.write(_dst)
+
+        for _verify, _expected in ((False, 60), (True, 10)):
+            c = Copier(block_size=4, verify=_verify)
+            _pos = c._find_resume_position(source_file="test_src.bin", destination_file="test_dst.bin", total_size_src=64, total_size_dst=64)
+            assert _pos == _expected, f"Result: {_verify=} {_pos=}"
+
+    def test_progress_in_place(self):
+        with patch("sys.stderr.isatty", return_value=True):
+            assert Copier(jobs=1)._Copier__progress_in_place
+            assert not Copier(jobs=2)._Copier__progress_in_place
+
     def test_directory_cache(self):
         _c = DirectoryCache()
         with open("test", "w+") as f:
@@ -99,10 +159,69 @@ class TestWithVirtualFileSystem(unittest.TestCase):
         assert _c.is_done(source_file="test", destination_file="test", copy_mode=CopyMode.NEW_FILES_ONLY) == FileStatus.NEW
         _c.set_done(source_file="test", destination_file="test")
         assert _c.is_done(source_file="test", destination_file="test", copy_mode=CopyMode.NEW_FILES_ONLY) == FileStatus.CACHED
+        _c.flush()
+
+        _c1 = DirectoryCache()
+        assert _c1.is_done(source_file="test", destination_file="test", copy_mode=CopyMode.NEW_FILES_ONLY) == FileStatus.CACHED
+
+    def test_directory_cache_compaction(self):
+        _c = DirectoryCache()
+        _c._min_log_entries = 1
+        with open("test", "w+") as f:
+            pass
+
+        _c.set_done(source_file="test", destination_file="test")
+        assert self.vfs.readtext(".cache.log").count("\n") == 1
+        _c.set_done(source_file="test", destination_file="test")
+        _c.set_done(source_file="test", destination_file="test")
+        _c.set_done(source_file="test", destination_file="test")
+        _c.set_done(source_file="test", destination_file="test")
+        assert self.vfs.readtext(".cache.log") == ""
+        assert self.vfs.exists(".cache")
 
         _c1 = DirectoryCache()
         assert _c1.is_done(source_file="test", destination_file="test", copy_mode=CopyMode.NEW_FILES_ONLY) == FileStatus.CACHED
 
+    def test_directory_cache_compaction_distinct_files(self):
+        _c = DirectoryCache()
+        _c._min_log_entries = 2
+        with open("test", "w+") as f:
+            pass
+        for i in range(12):
+            with open(f"dst{i}", "w+") as f:
+                pass
+
+        # the journal is bounded by the compacted cache file, not by the cache including the journal
+        for i in range(8):
+            _c.set_done(source_file="test", destination_file=f"dst{i}")
+        assert self.vfs.readtext(".cache.log").count("\n") == 8
+        _c.set_done(source_file="test", destination_file="dst8")
+        assert self.vfs.readtext(".cache.log") == ""
+        assert len(json.loads(self.vfs.readtext(".cache"))) == 9
+        for i in range(9, 12):
+            _c.set_done(source_file="test", destination_file=f"dst{i}")
+        assert self.vfs.readtext(".cache.log").count("\n") == 3
+
+        _c1 = DirectoryCache()
+        assert _c1._file_entries == 9
+        for i in range(12):
+            assert _c1.is_done(source_file="test", destination_file=f"dst{i}", copy_mode=CopyMode.NEW_FILES_ONLY) == FileStatus.CACHED
+
+    def test_directory_cache_torn_journal(self):
+        with open("test", "w+") as f:
+            pass
+        with open(".cache.log", "wb") as f:
+            f.write(b'{"k":"/x","v":1}\n[1]\n"k"\n{"v":3}\n{"k":"/y","v":2')
+
+        _c = DirectoryCache()
+        assert _c.is_done(source_file="test", destination_file="/y", copy_mode=CopyMode.NEW_FILES_ONLY) == FileStatus.NEW
+        _c.set_done(source_file="test", destination_file="test")
+        _c.flush()
+
+        _c1 = DirectoryCache()
+        assert "/x" in _c1._cache and "/y" not in _c1._cache
+        assert _c1.is_done(source_file="test", destination_file="test", copy_mode=CopyMode.NEW_FILES_ONLY) == FileStatus.CACHED
+
     def test_RollingMedian(self):
         _m = RollingMedian(window_size=3)
         assert _m.median() == 0
@@ -114,3 +233,309 @@ class TestWithVirtualFileSystem(unittest.TestCase):
         assert _m.median() == 20
         _m.add(40)
         assert _m.median() == 30
+
+    def test_RollingMedian_window(self):
+        # duplicates and values leaving the window in any order
+        _values = [(i * 37) % 11 for i in range(200)]
+        for _window_size in (1, 2, 5, 8):
+            _m = RollingMedian(window_size=_window_size)
+            for i, _value in enumerate(_values):
+                _m.add(_value)
+                _window = sorted(_values[max(0, i + 1 - _window_size) : i + 1])
+                _half = len(_window) // 2
+                _expected = _window[_half] if len(_window) % 2 else (_window[_half - 1] + _window[_half]) / 2
+                assert _m.median() == _expected, f"{_window_size=} {i=}"
+
+
+def _first_difference(data_src: bytes, data_dst: bytes) -> int:
+    # Brute force reference of the resume position
+    for i, (_byte_src, _byte_dst) in enumerate(zip(data_src, data_dst)):
+        if _byte_src != _byte_dst:
+            return i
+    return -1 if len(data_src) == len(data_dst) else min(len(data_src), len(data_dst))
+
+
+@contextmanager
+def _without(module, *names):
+    # Hide functions of a module, as on platforms lacking them
+    _saved = {_name: getattr(module, _name) for _name in names if hasattr(module, _name)}
+    for _name in _saved:
+        delattr(module, _name)
+    try:
+        yield
+    finally:
+        for _name, _function in _saved.items():
+            setattr(module, _name, _function)
+
+
+class TestWithRealFiles(unittest.TestCase):
+    """Files on disk, which are memory mapped unlike those of the virtual file system."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.file_src = os.path.join(self.tmp_dir.name, "src.bin")
+        self.file_dst = os.path.join(self.tmp_dir.name, "dst.bin")
+        self.data = random.Random(1).randbytes(1024 * 1024 + 13)
+        # the directory cache of Copier is kept next to the module, move it into the temporary directory
+        _file_patcher = patch("copier.__file__", new=os.path.join(self.tmp_dir.name, "copier.py"))
+        _file_patcher.start()
+        self.addCleanup(_file_patcher.stop)
+
+    def _write(self, data_src: bytes, data_dst: bytes) -> None:
+        with open(self.file_src, "wb") as f_src:
+            f_src.write(data_src)
+        with open(self.file_dst, "wb") as f_dst:
+            f_dst.write(data_dst)
+
+    def test_mapped_file(self):
+        self._write(self.data, b"")
+        with open(self.file_src, "rb") as f_src:
+            _v = MappedFile(f_src, len(self.data))
+            assert _v._mmap is not None
+            assert _v.read(100, 50) == self.data[100:150]
+            assert bytes(_v.view(len(self.data) - 20, 100)) == self.data[-20:]
+            _v.advise("MADV_RANDOM")
+            _v.advise("MADV_WILLNEED", 5000, 100)
+            _v.close()
+
+    @parameterized.expand(
+        [
+            ("truncated", 700_001, "truncated"),
+            ("zeroed tail", 12_345, "zero"),
+            ("zeroed tail unaligned", 1024 * 1024 - 3, "zero"),
+            ("random tail", 500_000, "random"),
+            ("equal", None, "equal"),
+            ("longer destination", None, "longer"),
+            ("damaged start", 0, "random"),
+        ]
+    )
+    def test_find_resume_position(self, _, bytes_good, damage):
+        _rnd = random.Random(2)
+        if damage == "truncated":
+            _data_dst = self.data[:bytes_good]
+        elif damage == "zero":
+            _data_dst = self.data[:bytes_good] + bytes(len(self.data) - bytes_good)
+        elif damage == "random":
+            _data_dst = self.data[:bytes_good] + bytes([self.data[bytes_good] ^ 0xFF]) + _rnd.randbytes(len(self.data) - bytes_good - 1)
+        elif damage == "longer":
+            _data_dst = self.data + b"excess"
+        else:
+            _data_dst = self.data
+        self._write(self.data, _data_dst)
+
+        _expected = _first_difference(self.data, _data_dst)
+        for _verify in (False, True):
+            c = Copier(verify=_verify)
+            _pos = c._find_resume_position(
+                source_file=self.file_src,
+                destination_file=self.file_dst,
+                total_size_src=len(self.data),
+                total_size_dst=len(_data_dst),
+            )
+            assert _pos == _expected, f"Result: {_verify=} {_pos=} {_expected=}"
+
+    def test_copy_directory_source_changed_after_walk(self):
+        _dir_src = os.path.join(self.tmp_dir.name, "src")
+        _dir_dst = os.path.join(self.tmp_dir.name, "dst")
+        os.makedirs(_dir_src)
+        os.makedirs(_dir_dst)
+        self.file_src = os.path.join(_dir_src, "file.bin")
+        self.file_dst = os.path.join(_dir_dst, "file.bin")
+        # a finished copy, with the modification time of its source
+        self._write(self.data, self.data)
+        _mtime_ns = os.stat(self.file_src).st_mtime_ns
+        os.utime(self.file_dst, ns=(_mtime_ns, _mtime_ns))
+        _data_changed = bytes([self.data[0] ^ 0xFF]) + self.data[1:]
+        _walk_files = Copier._walk_files
+
+        def _walk_then_change(src):
+            # the source is changed in place (same size) after the walk has taken its stat
+            _entries = list(_walk_files(src))
+            for _entry, _ in _entries:
+                _entry.stat()
+            with open(self.file_src, "r+b") as f_src:
+                f_src.write(_data_changed[:1])
+            os.utime(self.file_src, ns=(_mtime_ns + 10**9, _mtime_ns + 10**9))
+            yield from _entries
+
+        with patch.object(Copier, "_walk_files", new=staticmethod(_walk_then_change)):
+            Copier().copy(src=_dir_src, dst=_dir_dst)
+        with open(self.file_dst, "rb") as f_dst:
+            assert f_dst.read() == _data_changed
+        assert os.stat(self.file_dst).st_mtime_ns == _mtime_ns + 10**9
+
+    def _make_tree(self, files: dict[str, bytes]) -> tuple[str, str]:
+        # Source directory with the given files (relative path: content), and an empty destination directory
+        _dir_src = os.path.join(self.tmp_dir.name, "src")
+        _dir_dst = os.path.join(self.tmp_dir.name, "dst")
+        os.makedirs(_dir_dst)
+        for _path, _data in files.items():
+            _file = os.path.join(_dir_src, _path)
+            os.makedirs(os.path.dirname(_file), exist_ok=True)
+            with open(_file, "wb") as f:
+                f.write(_data)
+        return _dir_src, _dir_dst
+
+    def _damage_keeping_stat(self, file: str, offset: int) -> None:
+        # Changes a byte without changing size and modification time, which only a full comparison notices
+        _stat = os.stat(file)
+        with open(file, "r+b") as f:
+            f.seek(offset)
+            _byte = f.read(1)
+            f.seek(offset)
+            f.write(bytes([_byte[0] ^ 0xFF]))
+        os.utime(file, ns=(_stat.st_atime_ns, _stat.st_mtime_ns))
+
+    def test_copy_file_skips_equal_destination(self):
+        self._write(self.data, self.data)
+        _mtime_ns = os.stat(self.file_src).st_mtime_ns
+        os.utime(self.file_dst, ns=(_mtime_ns, _mtime_ns))
+        self._damage_keeping_stat(self.file_dst, len(self.data) // 2)
+
+        # same size and modification time as the source: taken as done without scanning
+        with patch.object(Copier, "_find_resume_position") as _find:
+            Copier().copy_file(src=self.file_src, dst=self.file_dst)
+        _find.assert_not_called()
+        with open(self.file_dst, "rb") as f_dst:
+            assert f_dst.read() != self.data
+
+        # verify scans nevertheless and repairs the damage
+        Copier(verify=True).copy_file(src=self.file_src, dst=self.file_dst)
+        with open(self.file_dst, "rb") as f_dst:
+            assert f_dst.read() == self.data
+
+    def test_copy_directory_verify_cached(self):
+        _dir_src, _dir_dst = self._make_tree({"a/file.bin": self.data})
+        _file_dst = os.path.join(_dir_dst, "a", "file.bin")
+        Copier().copy(src=_dir_src, dst=_dir_dst)
+        self._damage_keeping_stat(_file_dst, len(self.data) // 2)
+
+        # cached by the first copy, skipped without verify
+        Copier().copy(src=_dir_src, dst=_dir_dst)
+        with open(_file_dst, "rb") as f_dst:
+            assert f_dst.read() != self.data
+
+        Copier(verify=True).copy(src=_dir_src, dst=_dir_dst)
+        with open(_file_dst, "rb") as f_dst:
+            assert f_dst.read() == self.data
+
+    def test_copy_directory_parallel(self):
+        _rnd = random.Random(3)
+        _files = {os.path.join(f"d{i % 3}", f"s{i % 2}", f"f{i}.bin"): _rnd.randbytes(_rnd.randrange(200_000)) for i in range(12)}
+        _files["empty.bin"] = b""
+        _dir_src, _dir_dst = self._make_tree(_files)
+        # a partial copy, which is resumed
+        os.makedirs(os.path.join(_dir_dst, "d0", "s0"))
+        with open(os.path.join(_dir_dst, "d0", "s0", "f0.bin"), "wb") as f_dst:
+            f_dst.write(_files[os.path.join("d0", "s0", "f0.bin")][:1000])
+
+        # files above 64 KiB are copied by the copy loop, smaller ones by shutil.copyfile
+        with patch("copier._FAST_COPY_MAX_SIZE", 64 * 1024):
+            Copier(jobs=2).copy(src=_dir_src, dst=_dir_dst)
+
+        for _path, _data in _files.items():
+            with open(os.path.join(_dir_dst, _path), "rb") as f_dst:
+                assert f_dst.read() == _data, _path
+        _copied = {os.path.relpath(os.path.join(_dir, _name), _dir_dst) for _dir, _, _names in os.walk(_dir_dst) for _name in _names}
+        assert _copied == set(_files)
+
+    def test_copy_file_interrupted_preallocated(self):
+        self._write(self.data, b"")
+        os.remove(self.file_dst)
+        _copy_range = Copier._copy_range
+        _preallocate = copier._preallocate
+        _preallocated = []
+
+        def _interrupted_copy_range(self, f_src, f_dst, offset):
+            # interrupted by the user after the first chunk
+            for _length in _copy_range(self, f_src, f_dst, offset):
+                yield _length
+                self._Copier__abort.set()
+
+        def _recording_preallocate(file, size):
+            _preallocate(file, size)
+            _preallocated.append(os.fstat(file.fileno()).st_size)
+
+        with patch("copier._FAST_COPY_MAX_SIZE", 0), patch("copier._CHUNK_SIZE", 64 * 1024), patch(
+            "copier._preallocate", new=_recording_preallocate
+        ), patch.object(Copier, "_copy_range", new=_interrupted_copy_range):
+            Copier().copy_file(src=self.file_src, dst=self.file_dst)
+        # allocated up to the source size, unless the file system lacks fallocate
+        assert _preallocated in ([len(self.data)], [0]), _preallocated
+
+        # the preallocated remainder is cut, the copy is resumed behind the copied chunk
+        assert os.path.getsize(self.file_dst) == 64 * 1024
+        with patch("copier._FAST_COPY_MAX_SIZE", 0):
+            Copier().copy_file(src=self.file_src, dst=self.file_dst)
+        with open(self.file_dst, "rb") as f_dst:
+            assert f_dst.read() == self.data
+
+    def test_find_resume_position_zero_head(self):
+        # equal files starting with zeros, e.g. disk images, are found equal by the probes without a full scan
+        _data = bytes(8192) + self.data
+        self._write(_data, _data)
+        _view = MappedFile.view
+        _viewed = []
+
+        def _counting_view(self, offset, length):
+            _viewed.append(offset)
+            return _view(self, offset, length)
+
+        with patch.object(MappedFile, "view", new=_counting_view):
+            _pos = Copier()._find_resume_position(
+                source_file=self.file_src, destination_file=self.file_dst, total_size_src=len(_data), total_size_dst=len(_data)
+            )
+        assert _pos == -1
+        assert not _viewed, _viewed
+
+    def test_write_views_short_writes(self):
+        _pwritev = os.pwritev
+
+        def _short_pwritev(fd, buffers, offset):
+            # writes at most the first 5 bytes per call, which may end inside a buffer
+            return _pwritev(fd, [b"".join(buffers)[:5]], offset)
+
+        self._write(b"", b"")
+        _views = [memoryview(b"abcdefgh"), memoryview(b"ij"), memoryview(b"klmnop")]
+        with open(self.file_dst, "r+b") as f_dst, patch("os.pwritev", new=_short_pwritev):
+            copier._write_views(f_dst, f_dst.fileno(), 4, _views)
+        with open(self.file_dst, "rb") as f_dst:
+            assert f_dst.read() == b"\x00" * 4 + b"abcdefghijklmnop"
+
+    @parameterized.expand([("preadv pwritev", ()), ("read write", ("preadv", "pwritev"))])
+    def test_copy_range_fallback(self, _, missing):
+        self._write(self.data, self.data[:5000])
+        c = Copier()
+        with _without(os, "sendfile", "copy_file_range", *missing), patch("copier._CHUNK_SIZE", 64 * 1024):
+            with open(self.file_src, "rb") as f_src, open(self.file_dst, "r+b") as f_dst:
+                f_dst.seek(5000)
+                assert sum(c._copy_range(f_src, f_dst, 5000)) == len(self.data) - 5000
+        with open(self.file_dst, "rb") as f_dst:
+            assert f_dst.read() == self.data
+
+    def test_copy_range_fallback_abort(self):
+        self._write(self.data, b"")
+        c = Copier()
+        with _without(os, "sendfile", "copy_file_range"), patch("copier._CHUNK_SIZE", 64 * 1024):
+            with open(self.file_src, "rb") as f_src, open(self.file_dst, "r+b") as f_dst:
+                _copied = 0
+                for _length in c._copy_range(f_src, f_dst, 0):
+                    _copied += _length
+                    c._Copier__abort.set()
+        # chunks already read ahead and written in the same batch are still reported
+        assert 0 < _copied <= copier._PIPELINE_DEPTH * 64 * 1024
+        with open(self.file_dst, "rb") as f_dst:
+            assert f_dst.read(_copied) == self.data[:_copied]
+
+    def test_copy_range_fallback_read_error(self):
+        self._write(self.data, b"")
+        c = Copier()
+
+        class _FailingFile(io.BytesIO):
+            def readinto(self, buffer):
+                raise OSError(errno.EIO, "read failed")
+
+        with _without(os, "sendfile", "copy_file_range"), open(self.file_dst, "r+b") as f_dst:
+            with self.assertRaises(OSError):
+                list(c._copy_range(_FailingFile(self.data), f_dst, 0))